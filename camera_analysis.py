@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
-from flask import Flask, Response, render_template, request
+from flask import Flask, Response, render_template, request, url_for
+from markupsafe import escape
+from werkzeug.serving import WSGIRequestHandler
+import asyncio
+import glob
+import re
 import cv2
 import time
 import threading
@@ -8,16 +13,108 @@ import argparse
 import socket
 import logging
 
+from v4l2_capture import V4L2Capture, fourcc_from_str, fourcc_to_str
+
+# libjpeg-turbo is optional; fall back to OpenCV's encoder when it is missing
+try:
+    from turbojpeg import TurboJPEG, TJSAMP_420, TJPF_BGR
+    _tj = TurboJPEG()
+except Exception:
+    _tj = None
+
+# aiohttp (and uvloop) are optional, they are only needed for --async-stream-port
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Global variables
-frame_buffer = None
-buffer_lock = threading.Lock()
+# Triple-buffered frames: the capture thread fills a slot that is neither published nor
+# pinned by a reader and then flips buffer_idx, so a frame is never overwritten while
+# it is being encoded. Readers pin the front slot with claim_frame().
+FRAME_SLOTS = 3
+frame_slots = [None] * FRAME_SLOTS
+slot_readers = [0] * FRAME_SLOTS
+buffer_idx = 0
+# Bumped and signalled each time a new frame is published
+frame_seq = 0
+frame_cv = threading.Condition()
+# Stream tiers: clients whose sends get slow drop to a half-size, lower quality stream
+TIER_FULL = 0
+TIER_REDUCED = 1
+REDUCED_QUALITY = 60
+SLOW_SEND = 0.1
+FAST_SEND = 0.03
+# A reduced frame is several times smaller and goes out fast even on the link that was
+# too slow for full frames, so only move back up after a sustained run of fast sends
+UPGRADE_FAST_SENDS = 30
+MIN_TIER_TIME = 5.0
+# Per-tier rings of the last encoded frames as (frame_seq, multipart_parts, joined_part),
+# shared by every stream client. Only the encoder thread writes; readers index the ring without locking
+# and use jpeg_cv purely to sleep until the next frame.
+JPEG_RING_SIZE = 8
+jpeg_rings = [[None] * JPEG_RING_SIZE, [None] * JPEG_RING_SIZE]
+jpeg_heads = [0, 0]
+jpeg_cv = threading.Condition()
+tier_clients = [0, 0]
+# Callables invoked by the encoder thread after each published JPEG
+jpeg_listeners = []
+# The capture thread reads camera without locking; camera_lock only serialises
+# open_camera with index(). capture_cam is the handle the capture thread is using.
 camera = None
 camera_lock = threading.Lock()
+capture_cam = None
+capture_thread = None
+# Longest release_camera waits for the capture thread to move off the old handle. Handles
+# it is still blocked on are parked for the capture thread to release once it returns.
+RELEASE_TIMEOUT = 5.0
+parked_cameras = []
+# Arguments of the last open_camera call, used to reopen after capture failures
+camera_settings = None
+use_v4l2_mmap = False
+buffer_count = 4
+jpeg_quality = 80
+passthrough_mjpg = False
+# Planar YUV 4:2:0 formats kept raw from capture to encoder (12 bits per pixel instead of 24)
+RAW_YUV_FORMATS = ('YU12', 'YV12')
+yuv_fourcc = None
+async_stream_port = None
+use_opencl = False
+# /dev/video* listing shown on the index page, refreshed at most every DEVICE_CACHE_TTL seconds
+DEVICE_CACHE_TTL = 5.0
+video_devices_cache = (None, 0.0)
+# index.html rendered once by create_templates(), split into static text (even indexes)
+# and the names of the live fields filled in per request (odd indexes)
+index_shell_parts = None
+INDEX_FIELDS = ('stream_url', 'device_options', 'camera_status', 'camera_details')
+CAMERA_DETAILS_HTML = '''<table>
+                <tr>
+                    <th>Property</th>
+                    <th>Value</th>
+                </tr>
+                <tr>
+                    <td>Resolution</td>
+                    <td>{width} x {height}</td>
+                </tr>
+                <tr>
+                    <td>FPS</td>
+                    <td>{fps}</td>
+                </tr>
+                <tr>
+                    <td>Format</td>
+                    <td>{format}</td>
+                </tr>
+            </table>'''
 
 app = Flask(__name__)
 
@@ -34,102 +131,616 @@ def get_ip_address():
         s.close()
     return IP
 
+def encode_jpeg(img, quality=None):
+    """Encode a BGR frame to JPEG bytes, returns None on failure"""
+    if quality is None:
+        quality = jpeg_quality
+    
+    if _tj is not None:
+        return _tj.encode(img, quality=quality, jpeg_subsample=TJSAMP_420, pixel_format=TJPF_BGR)
+    
+    ret, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ret:
+        return None
+    return jpeg.tobytes()
+
+def is_compressed(frame):
+    """Check whether a captured frame is a compressed payload rather than a decoded image"""
+    # Compressed payloads arrive as a single row of bytes
+    return frame.ndim == 1 or (frame.ndim == 2 and frame.shape[0] == 1)
+
+def is_jpeg(frame):
+    """Check whether a captured frame is a raw JPEG payload rather than a decoded image"""
+    if not is_compressed(frame):
+        return False
+    return frame.size > 2 and frame.flat[0] == 0xFF and frame.flat[1] == 0xD8
+
+def is_yuv420(frame):
+    """Check whether a captured frame is a raw planar YUV 4:2:0 buffer of shape (h * 3/2, w)"""
+    return frame.ndim == 2 and frame.shape[0] > 1
+
+def yuv420_to_bgr(frame):
+    """Convert a raw YU12/YV12 frame to BGR"""
+    code = cv2.COLOR_YUV2BGR_YV12 if yuv_fourcc == 'YV12' else cv2.COLOR_YUV2BGR_I420
+    return cv2.cvtColor(frame, code)
+
+def encode_yuv420_jpeg(frame, quality=None):
+    """Encode a raw YUV 4:2:0 frame to JPEG bytes, returns None on failure"""
+    if quality is None:
+        quality = jpeg_quality
+    
+    # libjpeg-turbo takes I420 planes directly, skipping the colour conversion entirely
+    if _tj is not None and yuv_fourcc == 'YU12' and frame.flags.c_contiguous:
+        height = frame.shape[0] * 2 // 3
+        # align=1: V4L2 and OpenCV pack the chroma planes without row padding
+        return _tj.encode_from_yuv(frame, height, frame.shape[1], quality=quality,
+                                   jpeg_subsample=TJSAMP_420, align=1)
+    
+    return encode_jpeg(yuv420_to_bgr(frame), quality)
+
+def frame_to_jpeg(frame):
+    """Return JPEG bytes for a frame, passing MJPG payloads through without re-encoding"""
+    if is_compressed(frame):
+        if not is_jpeg(frame):
+            # A corrupt or unexpected payload, drop the frame rather than encode its bytes
+            return None
+        # The one copy per frame: the capture buffer is reused for the next grab
+        return frame.tobytes()
+    if is_yuv420(frame):
+        return encode_yuv420_jpeg(frame)
+    return encode_jpeg(frame)
+
+def notify_new_frame():
+    """Wake up everything waiting for a newly published frame"""
+    global frame_seq
+    
+    with frame_cv:
+        frame_seq += 1
+        frame_cv.notify_all()
+
+def allocate_frame_slots(first_frame):
+    """Preallocate the frame slots so capture reuses them instead of allocating per frame"""
+    global frame_slots, buffer_idx
+    
+    # Publish the first frame as the front slot so readers never see an uninitialised buffer
+    with frame_cv:
+        frame_slots = [first_frame] + [np.empty_like(first_frame) for _ in range(FRAME_SLOTS - 1)]
+        buffer_idx = 0
+        notify_new_frame()
+    logger.info(f"Allocated frame buffers of shape {first_frame.shape}")
+
+def claim_frame():
+    """Pin the published frame so capture will not write into it, returns (slot, frame)"""
+    with frame_cv:
+        slot = buffer_idx
+        slot_readers[slot] += 1
+        return slot, frame_slots[slot]
+
+def release_frame(slot):
+    """Unpin a slot taken with claim_frame"""
+    with frame_cv:
+        slot_readers[slot] -= 1
+        frame_cv.notify_all()
+
+def back_slot():
+    """Pick the slot to capture into, waiting for a reader if every other slot is pinned"""
+    with frame_cv:
+        while True:
+            for slot in range(FRAME_SLOTS):
+                if slot != buffer_idx and not slot_readers[slot]:
+                    return slot
+            frame_cv.wait()
+
+def configure_opencv_capture(cap, fourcc=None, width=None, height=None):
+    """Apply format settings to an OpenCV VideoCapture"""
+    # Set properties if specified
+    if fourcc:
+        fourcc_int = fourcc_from_str(fourcc)
+        cap.set(cv2.CAP_PROP_FOURCC, fourcc_int)
+        logger.info(f"Set fourcc to {fourcc}")
+    
+    if width and height:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        logger.info(f"Set resolution to {width}x{height}")
+    
+    # A deeper driver queue absorbs scheduling jitter between frames
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_count)
+
+def release_camera():
+    """Unpublish the current camera and release it once the capture thread has let go of it"""
+    global camera
+    
+    old = camera
+    camera = None
+    if old is None:
+        return
+    
+    # The capture thread reads the handle without a lock, wait until it has moved off this one
+    deadline = time.monotonic() + RELEASE_TIMEOUT
+    while capture_cam is old:
+        if capture_thread is None or not capture_thread.is_alive():
+            break
+        if time.monotonic() > deadline:
+            # Releasing now would close the device under a grab() that is still running
+            logger.warning("Capture thread is still using the camera, leaving it to release it")
+            parked_cameras.append(old)
+            return
+        time.sleep(0.01)
+    
+    if old.isOpened():
+        old.release()
+
 def open_camera(device_path, fourcc=None, width=None, height=None):
     """Open camera with specific settings"""
-    global camera
+    global camera, camera_settings, yuv_fourcc
     
     with camera_lock:
+        camera_settings = (device_path, fourcc, width, height)
+        
         # Close existing camera if open
-        if camera is not None and camera.isOpened():
-            camera.release()
+        release_camera()
         
-        # Create new VideoCapture
-        camera = cv2.VideoCapture(device_path, cv2.CAP_V4L2)
+        if passthrough_mjpg:
+            fourcc = 'MJPG'
         
-        if not camera.isOpened():
+        if use_v4l2_mmap:
+            # The direct V4L2 path negotiates the format before mapping its buffers
+            cam = V4L2Capture(device_path, fourcc, width, height, buffer_count)
+        else:
+            cam = cv2.VideoCapture(device_path, cv2.CAP_V4L2)
+        
+        if not cam.isOpened():
             logger.error(f"Failed to open camera: {device_path}")
             return False
         
-        # Set properties if specified
-        if fourcc:
-            fourcc_int = cv2.VideoWriter_fourcc(*fourcc)
-            camera.set(cv2.CAP_PROP_FOURCC, fourcc_int)
-            logger.info(f"Set fourcc to {fourcc}")
-        
-        if width and height:
-            camera.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-            logger.info(f"Set resolution to {width}x{height}")
+        if not use_v4l2_mmap:
+            configure_opencv_capture(cam, fourcc, width, height)
         
         # Log camera properties
-        actual_fourcc = int(camera.get(cv2.CAP_PROP_FOURCC))
-        fourcc_str = "".join([chr((actual_fourcc >> 8 * i) & 0xFF) for i in range(4)])
-        actual_width = int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))
-        actual_height = int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        actual_fourcc = int(cam.get(cv2.CAP_PROP_FOURCC))
+        fourcc_str = fourcc_to_str(actual_fourcc)
+        actual_width = int(cam.get(cv2.CAP_PROP_FRAME_WIDTH))
+        actual_height = int(cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        actual_buffers = int(cam.get(cv2.CAP_PROP_BUFFERSIZE))
         
         logger.info(f"Camera configured with:")
         logger.info(f"- Device: {device_path}")
         logger.info(f"- FOURCC: {fourcc_str} ({actual_fourcc})")
         logger.info(f"- Resolution: {actual_width}x{actual_height}")
+        logger.info(f"- Buffers: {actual_buffers} (requested {buffer_count})")
+        
+        # Keep the compressed MJPG buffer in passthrough mode, and planar YUV 4:2:0 otherwise,
+        # instead of converting to BGR. Anything else the camera settled on is converted.
+        if passthrough_mjpg:
+            keep_raw = fourcc_str == 'MJPG'
+        else:
+            keep_raw = fourcc_str in RAW_YUV_FORMATS
+        cam.set(cv2.CAP_PROP_CONVERT_RGB, 0 if keep_raw else 1)
+        yuv_fourcc = fourcc_str if keep_raw and not passthrough_mjpg else None
+        if keep_raw:
+            logger.info(f"Passing {fourcc_str} frames to the encoder without BGR conversion")
+        
+        # Learn the decoded frame shape so capture can write into persistent buffers.
+        # MJPG payloads vary in size per frame, so those are left to OpenCV, and the
+        # direct V4L2 path hands out views of its own mmap'd buffers.
+        if not passthrough_mjpg and not use_v4l2_mmap:
+            ret, frame = cam.read()
+            if ret:
+                allocate_frame_slots(frame)
         
+        # Publish the fully configured handle to the capture thread
+        camera = cam
         return True
 
+# A grab that returns faster than this took a frame that was already queued in the driver
+STALE_GRAB_TIME = 0.002
+
+def grab_latest(cam):
+    """Grab the newest frame from an OpenCV capture, skipping frames queued up in the driver
+    
+    grab() only dequeues a buffer, the decode happens in retrieve(), so stale frames are
+    dropped for the cost of one ioctl each.
+    """
+    for _ in range(buffer_count):
+        started = time.monotonic()
+        if not cam.grab():
+            return False
+        # Having to wait for the driver means this frame has just been captured
+        if time.monotonic() - started > STALE_GRAB_TIME:
+            break
+    return True
+
+def capture_step(cam):
+    """Capture one frame into the back slot and publish it, returns False on failure
+    
+    Picks a free slot, grabs the newest frame, retrieves it into that slot, then
+    makes it the published frame and wakes up the waiting readers.
+    """
+    global buffer_idx
+    
+    back = back_slot()
+    # V4L2Capture drains its queue inside grab()
+    if not (cam.grab() if use_v4l2_mmap else grab_latest(cam)):
+        return False
+    
+    ret, frame = cam.retrieve(frame_slots[back])
+    if not ret:
+        return False
+    
+    frame_slots[back] = frame
+    buffer_idx = back
+    notify_new_frame()
+    return True
+
 def camera_capture_thread(interval=0.1):
-    """Background thread to continuously capture frames"""
-    global frame_buffer, camera
+    """Background thread to continuously capture frames
+    
+    Capture is paced by the camera itself; interval is only the back-off after a failed read.
+    """
+    global capture_cam
     
     logger.info("Starting camera capture thread")
     
     consecutive_failures = 0
     while True:
-        with camera_lock:
-            if camera is None or not camera.isOpened():
-                time.sleep(0.5)
-                continue
-                
-            ret, frame = camera.read()
+        # Announce the handle before using it, then make sure it was not unpublished meanwhile
+        cam = camera
+        capture_cam = cam
+        if cam is not camera:
+            continue
+        
+        # Release handles release_camera gave up waiting for, this thread is off them now
+        while parked_cameras:
+            old = parked_cameras.pop()
+            if old.isOpened():
+                old.release()
         
-        if ret:
+        if cam is None or not cam.isOpened():
+            time.sleep(0.5)
+            continue
+        
+        try:
+            captured = capture_step(cam)
+        except Exception as e:
+            # A bad frame or driver error must not take the capture thread down
+            logger.error(f"Frame capture raised: {e}")
+            captured = False
+        
+        if captured:
             consecutive_failures = 0
-            with buffer_lock:
-                frame_buffer = frame
         else:
             consecutive_failures += 1
             logger.warning(f"Frame capture failed ({consecutive_failures} consecutive failures)")
             
             if consecutive_failures >= 5:
                 logger.error("Too many consecutive failures, attempting to reopen camera")
-                with camera_lock:
-                    device = camera.get(cv2.CAP_PROP_BACKEND)
-                    camera.release()
-                    camera = cv2.VideoCapture(device, cv2.CAP_V4L2)
+                # Let go of the handle first so open_camera can release it
+                capture_cam = None
+                open_camera(*camera_settings)
                 consecutive_failures = 0
+            
+            time.sleep(interval)
+
+def encode_tier(img, tier):
+    """Encode a frame for one stream tier"""
+    # MJPG passthrough frames are served as-is to every tier
+    if tier == TIER_FULL or is_compressed(img):
+        return frame_to_jpeg(img)
+    
+    if is_yuv420(img):
+        img = yuv420_to_bgr(img)
+    
+    # pyrDown halves each dimension in one SIMD blur+decimate pass
+    if use_opencl:
+        # Let OpenCV dispatch the resize to the GPU and only download the result
+        small = cv2.pyrDown(cv2.UMat(img)).get()
+    else:
+        small = cv2.pyrDown(img)
+    return encode_jpeg(small, min(jpeg_quality, REDUCED_QUALITY))
+
+def publish_jpeg(tier, seq, jpeg):
+    """Append an encoded frame to a tier's ring (encoder thread only)"""
+    head = jpeg_heads[tier]
+    # Build the multipart pieces once here so clients only hand out references. The
+    # aiohttp stream writes whole parts, so join them once for all of its clients too.
+    parts = multipart_parts(jpeg)
+    joined = b''.join(parts) if async_stream_port else None
+    jpeg_rings[tier][head % JPEG_RING_SIZE] = (seq, parts, joined)
+    # Advance the head only once the entry is in place
+    jpeg_heads[tier] = head + 1
+
+def latest_jpeg(tier):
+    """Return the newest (frame_seq, multipart_parts, joined_part) of a tier, or None before the first frame"""
+    head = jpeg_heads[tier]
+    if head == 0:
+        return None
+    return jpeg_rings[tier][(head - 1) % JPEG_RING_SIZE]
+
+def jpeg_encoder_thread():
+    """Background thread that encodes each captured frame once per tier for all stream clients"""
+    logger.info("Starting JPEG encoder thread")
+    
+    last_seq = 0
+    while True:
+        # Only spend CPU on encoding while somebody is watching
+        with frame_cv:
+            frame_cv.wait_for(lambda: frame_seq != last_seq and any(tier_clients))
+            last_seq = frame_seq
+            active_tiers = [tier for tier, clients in enumerate(tier_clients) if clients]
+            slot, img = claim_frame()
         
-        time.sleep(interval)
+        try:
+            if img is None:
+                continue
+            
+            for tier in active_tiers:
+                try:
+                    jpeg = encode_tier(img, tier)
+                except Exception as e:
+                    # Every stream client depends on this thread, so drop the frame instead
+                    logger.error(f"Encoding frame for tier {tier} raised: {e}")
+                    continue
+                if jpeg is not None:
+                    publish_jpeg(tier, last_seq, jpeg)
+        finally:
+            release_frame(slot)
+        
+        with jpeg_cv:
+            jpeg_cv.notify_all()
+        
+        for notify in jpeg_listeners:
+            notify()
+
+def render_placeholder_jpeg():
+    """Encode the frame shown while no camera frame is available"""
+    img = np.zeros((480, 640, 3), dtype=np.uint8)
+    text = "Waiting for camera..."
+    cv2.putText(img, text, (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return encode_jpeg(img)
+
+FRAME_BOUNDARY = b'--frame\r\n'
+
+def multipart_parts(jpeg):
+    """Split a multipart/x-mixed-replace part into (header, payload, trailer)
+    
+    The pieces are written separately so the JPEG is never copied into a
+    concatenated buffer.
+    """
+    header = (FRAME_BOUNDARY +
+              b'Content-Type: image/jpeg\r\n'
+              b'Content-Length: %d\r\n\r\n' % len(jpeg))
+    return header, jpeg, b'\r\n'
+
+# The placeholder never changes, so encode it once instead of on every idle iteration
+_IDLE_JPEG = render_placeholder_jpeg()
+_IDLE_PARTS = multipart_parts(_IDLE_JPEG) if _IDLE_JPEG is not None else None
+_IDLE_PART = b''.join(_IDLE_PARTS) if _IDLE_PARTS is not None else None
+
+def move_stream_client(old_tier, new_tier):
+    """Register a stream client joining, leaving (None) or switching tiers"""
+    with frame_cv:
+        if old_tier is not None:
+            tier_clients[old_tier] -= 1
+        if new_tier is not None:
+            tier_clients[new_tier] += 1
+        frame_cv.notify_all()
+
+class StreamTier:
+    """Picks a stream client's tier from how long its frames take to send"""
+    
+    def __init__(self):
+        self.tier = TIER_FULL
+        self.since = time.monotonic()
+        self.fast_sends = 0
+        move_stream_client(None, self.tier)
+    
+    def update(self, send_time):
+        if self.tier == TIER_FULL:
+            if send_time > SLOW_SEND:
+                self._move(TIER_REDUCED)
+            return
+        
+        if send_time >= FAST_SEND:
+            self.fast_sends = 0
+            return
+        
+        self.fast_sends += 1
+        if self.fast_sends >= UPGRADE_FAST_SENDS and time.monotonic() - self.since >= MIN_TIER_TIME:
+            self._move(TIER_FULL)
+    
+    def _move(self, new_tier):
+        move_stream_client(self.tier, new_tier)
+        self.tier = new_tier
+        self.since = time.monotonic()
+        self.fast_sends = 0
+    
+    def close(self):
+        move_stream_client(self.tier, None)
 
 def generate_frames():
     """Generate MJPEG frames for streaming"""
-    global frame_buffer
+    client = StreamTier()
     
-    while True:
-        with buffer_lock:
-            if frame_buffer is None:
-                # If no frame is available, generate a black frame
-                img = np.zeros((480, 640, 3), dtype=np.uint8)
-                text = "Waiting for camera..."
-                cv2.putText(img, text, (50, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    try:
+        last_seq = -1
+        last_parts = None
+        while True:
+            tier = client.tier
+            # Sleep until the encoder publishes a frame we have not sent yet
+            with jpeg_cv:
+                fresh = jpeg_cv.wait_for(lambda: jpeg_heads[tier] and latest_jpeg(tier)[0] > last_seq, timeout=1.0)
+            
+            if fresh:
+                last_seq, parts, _ = latest_jpeg(tier)
+            elif frame_slots[buffer_idx] is None:
+                # If no frame is available, send the cached black frame
+                parts = _IDLE_PARTS
             else:
-                img = frame_buffer.copy()
-        
-        # Convert to JPEG for streaming
-        ret, jpeg = cv2.imencode('.jpg', img)
-        if not ret:
-            continue
+                # Nothing new for a while, resend the last frame so a closed socket is noticed
+                parts = last_parts
             
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+            if parts is None:
+                continue
+            
+            # The generator resumes once the server has written the frame to the socket
+            started = time.monotonic()
+            yield from parts
+            if fresh:
+                client.update(time.monotonic() - started)
+            last_parts = parts
+    finally:
+        client.close()
+
+class AsyncFrameSignal:
+    """Lets coroutines on an event loop wait for JPEGs published by the encoder thread"""
+    
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+    
+    def notify(self):
+        # Called from the encoder thread
+        self.loop.call_soon_threadsafe(self._wake)
+    
+    def _wake(self):
+        future, self.future = self.future, self.loop.create_future()
+        future.set_result(None)
+    
+    async def wait(self, timeout):
+        """Wait for the next notify, returns False if timeout passed first"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+def make_async_stream_handler(signal):
+    """Build the aiohttp /stream handler, sending each frame as the encoder publishes it"""
+    async def async_stream(request):
+        response = web.StreamResponse(headers={'Content-Type': 'multipart/x-mixed-replace; boundary=frame'})
+        await response.prepare(request)
         
-        time.sleep(0.05)  # Limit frame rate
+        client = StreamTier()
+        
+        try:
+            last_seq = -1
+            last_part = None
+            while True:
+                latest = latest_jpeg(client.tier)
+                fresh = latest is not None and latest[0] > last_seq
+                if not fresh:
+                    if await signal.wait(1.0):
+                        # Woken by a publish, check for a new frame again
+                        continue
+                    latest = latest_jpeg(client.tier)
+                    fresh = latest is not None and latest[0] > last_seq
+                
+                if fresh:
+                    last_seq, _, part = latest
+                elif frame_slots[buffer_idx] is None:
+                    part = _IDLE_PART
+                else:
+                    # Nothing new for a while, resend the last frame so a closed socket is noticed
+                    part = last_part
+                
+                if part is None:
+                    continue
+                
+                started = time.monotonic()
+                # One write of the shared joined part, so each frame goes out in a single send
+                await response.write(part)
+                if fresh:
+                    client.update(time.monotonic() - started)
+                last_part = part
+        except ConnectionResetError:
+            pass
+        finally:
+            client.close()
+        
+        return response
+    
+    return async_stream
+
+def async_stream_server_thread(host, port):
+    """Background thread serving /stream from an aiohttp event loop"""
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    
+    signal = AsyncFrameSignal(loop)
+    jpeg_listeners.append(signal.notify)
+    
+    stream_app = web.Application()
+    stream_app.router.add_get('/stream', make_async_stream_handler(signal))
+    
+    runner = web.AppRunner(stream_app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    logger.info(f"Serving async stream on port {port} ({'uvloop' if uvloop is not None else 'asyncio'})")
+    
+    loop.run_forever()
+
+class GatherSocketWriter:
+    """wfile replacement that sends everything written since the last flush with one sendmsg
+    
+    Werkzeug flushes after every item of the response, so the flushes following a
+    multipart frame's header and payload are held back and the whole frame goes
+    out with the trailer.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = []
+        self.deferred_flushes = 0
+        self.closed = False
+    
+    def write(self, data):
+        if data.startswith(FRAME_BOUNDARY):
+            self.deferred_flushes = 2
+        self.pending.append(memoryview(data))
+        return len(data)
+    
+    def flush(self):
+        if self.deferred_flushes:
+            self.deferred_flushes -= 1
+            return
+        self._send()
+    
+    def _send(self):
+        buffers, self.pending = self.pending, []
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            # Drop what the kernel took and retry with the remainder
+            while buffers and sent >= buffers[0].nbytes:
+                sent -= buffers[0].nbytes
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
+    
+    def close(self):
+        if not self.closed:
+            try:
+                self._send()
+            finally:
+                self.closed = True
+
+class GatherRequestHandler(WSGIRequestHandler):
+    """Request handler that batches chunk framing and payload into a single syscall"""
+    
+    def setup(self):
+        super().setup()
+        self.wfile = GatherSocketWriter(self.connection)
+
+def list_video_devices():
+    """Return the sorted /dev/video* paths, cached briefly so page loads don't rescan /dev"""
+    global video_devices_cache
+    
+    devices, scanned_at = video_devices_cache
+    now = time.monotonic()
+    if devices is None or now - scanned_at > DEVICE_CACHE_TTL:
+        devices = sorted(glob.glob('/dev/video*'))
+        video_devices_cache = (devices, now)
+    return devices
 
 # Web routes
 @app.route('/')
@@ -138,24 +749,34 @@ def index():
     with camera_lock:
         if camera is None or not camera.isOpened():
             camera_status = "Not connected"
-            camera_info = {}
+            camera_details = ""
         else:
             camera_status = "Connected"
-            camera_info = {
-                "width": int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                "height": int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                "fps": camera.get(cv2.CAP_PROP_FPS),
-                "format": int(camera.get(cv2.CAP_PROP_FOURCC))
-            }
+            camera_details = CAMERA_DETAILS_HTML.format(
+                width=int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                height=int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                fps=camera.get(cv2.CAP_PROP_FPS),
+                format=int(camera.get(cv2.CAP_PROP_FOURCC))
+            )
     
     # Get list of video devices
-    import glob
-    video_devices = sorted(glob.glob('/dev/video*'))
+    device_options = "".join(f'<option value="{escape(device)}">{escape(device)}</option>'
+                             for device in list_video_devices())
     
-    return render_template('index.html', 
-                          camera_status=camera_status,
-                          camera_info=camera_info,
-                          video_devices=video_devices)
+    # Point the viewer at the async stream server when it is running
+    if async_stream_port:
+        hostname = re.sub(r':\d+$', '', request.host)
+        stream_url = f"//{escape(hostname)}:{async_stream_port}/stream"
+    else:
+        stream_url = url_for('stream')
+    
+    fields = {
+        "stream_url": stream_url,
+        "device_options": device_options,
+        "camera_status": camera_status,
+        "camera_details": camera_details,
+    }
+    return "".join(fields[part] if i % 2 else part for i, part in enumerate(index_shell_parts))
 
 @app.route('/stream')
 def stream():
@@ -176,6 +797,13 @@ def connect_camera():
     height = int(height) if height.isdigit() else None
     fourcc = fourcc if fourcc else None
     
+    # Reject bad codes before the current camera is released
+    if fourcc:
+        try:
+            fourcc_from_str(fourcc)
+        except ValueError:
+            return "FOURCC must be four ASCII characters", 400
+    
     success = open_camera(device, fourcc, width, height)
     if success:
         return "Camera connected successfully"
@@ -185,21 +813,25 @@ def connect_camera():
 @app.route('/snapshot')
 def snapshot():
     """Take a snapshot and return it as a downloadable image"""
-    global frame_buffer
-    
-    with buffer_lock:
-        if frame_buffer is None:
-            return "No frame available", 400
+    # Reuse the streamed JPEG when it is already the latest frame
+    latest = latest_jpeg(TIER_FULL)
+    if latest is not None and latest[0] == frame_seq:
+        _, jpeg, _ = latest[1]
+    else:
+        slot, img = claim_frame()
+        try:
+            if img is None:
+                return "No frame available", 400
+            jpeg = frame_to_jpeg(img)
+        finally:
+            release_frame(slot)
         
-        img = frame_buffer.copy()
-    
-    ret, jpeg = cv2.imencode('.jpg', img)
-    if not ret:
-        return "Failed to encode image", 500
+        if jpeg is None:
+            return "Failed to encode image", 500
     
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     return Response(
-        jpeg.tobytes(),
+        jpeg,
         mimetype="image/jpeg",
         headers={"Content-Disposition": f"attachment;filename=snapshot_{timestamp}.jpg"}
     )
@@ -208,12 +840,15 @@ def create_templates():
     """Create the HTML templates needed for the web interface"""
     import os
     
+    # Write next to the script, where Flask looks for templates, whatever the working directory
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    
     # Create templates directory if it doesn't exist
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
+    if not os.path.exists(template_dir):
+        os.makedirs(template_dir)
     
     # Create index.html template
-    with open('templates/index.html', 'w') as f:
+    with open(os.path.join(template_dir, 'index.html'), 'w') as f:
         f.write('''
 <!DOCTYPE html>
 <html>
@@ -312,7 +947,7 @@ def create_templates():
         </div>
         
         <div class="video-container">
-            <img src="{{ url_for('stream') }}" class="video-stream" alt="Camera Stream">
+            <img src="{{ stream_url }}" class="video-stream" alt="Camera Stream">
         </div>
         
         <div class="controls">
@@ -320,13 +955,12 @@ def create_templates():
             <form action="{{ url_for('connect_camera') }}" method="post" id="camera-form">
                 <label for="device">Camera Device:</label>
                 <select name="device" id="device">
-                    {% for device in video_devices %}
-                    <option value="{{ device }}">{{ device }}</option>
-                    {% endfor %}
+                    {{ device_options }}
                 </select>
                 
                 <label for="fourcc">Format (FOURCC):</label>
                 <select name="fourcc" id="fourcc">
+                    <option value="YU12">YU12 (YUV 4:2:0 planar)</option>
                     <option value="BGR3">BGR3 (BGR 24-bit)</option>
                     <option value="YV12">YV12 (YUV 12-bit)</option>
                     <option value="MJPG">MJPG (Motion JPEG)</option>
@@ -349,26 +983,7 @@ def create_templates():
             <h2>Camera Status</h2>
             <p><strong>Status:</strong> {{ camera_status }}</p>
             
-            {% if camera_info %}
-            <table>
-                <tr>
-                    <th>Property</th>
-                    <th>Value</th>
-                </tr>
-                <tr>
-                    <td>Resolution</td>
-                    <td>{{ camera_info.width }} x {{ camera_info.height }}</td>
-                </tr>
-                <tr>
-                    <td>FPS</td>
-                    <td>{{ camera_info.fps }}</td>
-                </tr>
-                <tr>
-                    <td>Format</td>
-                    <td>{{ camera_info.format }}</td>
-                </tr>
-            </table>
-            {% endif %}
+            {{ camera_details }}
         </div>
     </div>
     
@@ -398,17 +1013,57 @@ def create_templates():
 </body>
 </html>
         ''')
+    
+    # Render the page once with markers in place of the live fields, so index()
+    # only has to splice in a few strings instead of running Jinja per request
+    global index_shell_parts
+    with app.test_request_context():
+        shell = render_template('index.html', **{name: f"@@{name}@@" for name in INDEX_FIELDS})
+    index_shell_parts = re.split(r'@@(' + '|'.join(INDEX_FIELDS) + r')@@', shell)
 
 def main():
     parser = argparse.ArgumentParser(description='Raspberry Pi Camera Web Server')
     parser.add_argument('--port', type=int, default=8080, help='Port to run the server on')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
     parser.add_argument('--device', type=str, default=None, help='Video device path (e.g., /dev/video14)')
-    parser.add_argument('--fourcc', type=str, default=None, help='FOURCC code (e.g., BGR3, YV12)')
+    parser.add_argument('--fourcc', type=str, default='YU12',
+                        help='FOURCC code (e.g., BGR3, YV12), defaults to planar YUV 4:2:0 (YU12)')
     parser.add_argument('--width', type=int, default=None, help='Desired frame width')
     parser.add_argument('--height', type=int, default=None, help='Desired frame height')
+    parser.add_argument('--passthrough-mjpg', action='store_true',
+                        help='Capture MJPG and stream the camera\'s JPEG frames without re-encoding')
+    parser.add_argument('--v4l2-mmap', action='store_true',
+                        help='Capture directly from V4L2 mmap buffers instead of through OpenCV')
+    parser.add_argument('--buffers', type=int, default=4, help='Number of V4L2 capture buffers to request')
+    parser.add_argument('--async-stream-port', type=int, default=None,
+                        help='Serve /stream from an aiohttp event loop on this port (requires aiohttp)')
+    parser.add_argument('--opencl', action='store_true',
+                        help='Run frame resizing through OpenCL (cv2.UMat) when available')
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality for streaming and snapshots (1-100)')
     
     args = parser.parse_args()
+    if args.fourcc:
+        try:
+            fourcc_from_str(args.fourcc)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    global jpeg_quality, passthrough_mjpg, use_v4l2_mmap, buffer_count, async_stream_port, use_opencl
+    global capture_thread
+    jpeg_quality = max(1, min(100, args.quality))
+    passthrough_mjpg = args.passthrough_mjpg
+    use_v4l2_mmap = args.v4l2_mmap
+    buffer_count = max(1, args.buffers)
+    if _tj is None:
+        logger.warning("PyTurboJPEG not available, using OpenCV JPEG encoder")
+    
+    if args.opencl:
+        use_opencl = cv2.ocl.haveOpenCL()
+        cv2.ocl.setUseOpenCL(use_opencl)
+        if use_opencl:
+            logger.info(f"Using OpenCL device: {cv2.ocl.Device.getDefault().name()}")
+        else:
+            logger.warning("OpenCL not available, resizing on the CPU")
     
     # Create HTML templates
     create_templates()
@@ -421,12 +1076,27 @@ def main():
     capture_thread = threading.Thread(target=camera_capture_thread, daemon=True)
     capture_thread.start()
     
+    # Start background thread for encoding frames shared by all stream clients
+    encoder_thread = threading.Thread(target=jpeg_encoder_thread, daemon=True)
+    encoder_thread.start()
+    
+    # Start the async stream server alongside Flask if requested
+    if args.async_stream_port:
+        if web is None:
+            logger.error("aiohttp not available, serving /stream from Flask instead")
+        else:
+            async_stream_port = args.async_stream_port
+            stream_thread = threading.Thread(target=async_stream_server_thread,
+                                             args=(args.host, async_stream_port), daemon=True)
+            stream_thread.start()
+    
     # Get IP address
     ip_address = get_ip_address()
     logger.info(f"Starting server at http://{ip_address}:{args.port}")
     
     # Run the Flask app
-    app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    app.run(host=args.host, port=args.port, debug=False, threaded=True,
+            request_handler=GatherRequestHandler)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""Direct V4L2 mmap capture for camera_analysis.py
+
+Frames are dequeued straight from the driver's DMA buffers and exposed as
+numpy views of the mmap'd memory, so no copy is made until a consumer
+needs one. V4L2Capture mimics the parts of cv2.VideoCapture used by the
+web server so either backend can be plugged in.
+"""
+import ctypes
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import select
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ioctl request encoding from <asm-generic/ioctl.h>
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _ioc(direction, nr, struct_type):
+    return (direction << 30) | (ctypes.sizeof(struct_type) << 16) | (ord('V') << 8) | nr
+
+# Constants from <linux/videodev2.h>
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [
+        ('driver', ctypes.c_char * 16),
+        ('card', ctypes.c_char * 32),
+        ('bus_info', ctypes.c_char * 32),
+        ('version', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('device_caps', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3),
+    ]
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+        ('pixelformat', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('bytesperline', ctypes.c_uint32),
+        ('sizeimage', ctypes.c_uint32),
+        ('colorspace', ctypes.c_uint32),
+        ('priv', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('ycbcr_enc', ctypes.c_uint32),
+        ('quantization', ctypes.c_uint32),
+        ('xfer_func', ctypes.c_uint32),
+    ]
+
+class _v4l2_format_union(ctypes.Union):
+    # The kernel union contains pointers (struct v4l2_window), so it is pointer aligned
+    _fields_ = [
+        ('pix', v4l2_pix_format),
+        ('raw_data', ctypes.c_uint8 * 200),
+        ('_align', ctypes.c_void_p),
+    ]
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('fmt', _v4l2_format_union),
+    ]
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [
+        ('numerator', ctypes.c_uint32),
+        ('denominator', ctypes.c_uint32),
+    ]
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [
+        ('capability', ctypes.c_uint32),
+        ('capturemode', ctypes.c_uint32),
+        ('timeperframe', v4l2_fract),
+        ('extendedmode', ctypes.c_uint32),
+        ('readbuffers', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 4),
+    ]
+
+class _v4l2_streamparm_union(ctypes.Union):
+    _fields_ = [
+        ('capture', v4l2_captureparm),
+        ('raw_data', ctypes.c_uint8 * 200),
+    ]
+
+class v4l2_streamparm(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('parm', _v4l2_streamparm_union),
+    ]
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('flags', ctypes.c_uint8),
+        ('reserved', ctypes.c_uint8 * 3),
+    ]
+
+class timeval(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_usec', ctypes.c_long),
+    ]
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('frames', ctypes.c_uint8),
+        ('seconds', ctypes.c_uint8),
+        ('minutes', ctypes.c_uint8),
+        ('hours', ctypes.c_uint8),
+        ('userbits', ctypes.c_uint8 * 4),
+    ]
+
+class _v4l2_buffer_m(ctypes.Union):
+    _fields_ = [
+        ('offset', ctypes.c_uint32),
+        ('userptr', ctypes.c_ulong),
+        ('planes', ctypes.c_void_p),
+        ('fd', ctypes.c_int32),
+    ]
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('bytesused', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('timestamp', timeval),
+        ('timecode', v4l2_timecode),
+        ('sequence', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('m', _v4l2_buffer_m),
+        ('length', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+    ]
+
+VIDIOC_QUERYCAP = _ioc(_IOC_READ, 0, v4l2_capability)
+VIDIOC_G_FMT = _ioc(_IOC_READ | _IOC_WRITE, 4, v4l2_format)
+VIDIOC_S_FMT = _ioc(_IOC_READ | _IOC_WRITE, 5, v4l2_format)
+VIDIOC_REQBUFS = _ioc(_IOC_READ | _IOC_WRITE, 8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _ioc(_IOC_READ | _IOC_WRITE, 9, v4l2_buffer)
+VIDIOC_QBUF = _ioc(_IOC_READ | _IOC_WRITE, 15, v4l2_buffer)
+VIDIOC_DQBUF = _ioc(_IOC_READ | _IOC_WRITE, 17, v4l2_buffer)
+VIDIOC_STREAMON = _ioc(_IOC_WRITE, 18, ctypes.c_int)
+VIDIOC_STREAMOFF = _ioc(_IOC_WRITE, 19, ctypes.c_int)
+VIDIOC_G_PARM = _ioc(_IOC_READ | _IOC_WRITE, 21, v4l2_streamparm)
+
+def fourcc_from_str(code):
+    """Pack a four character code such as 'MJPG' into its little-endian integer"""
+    if len(code) != 4 or not code.isascii():
+        raise ValueError(f"FOURCC must be four ASCII characters, got {code!r}")
+    return int.from_bytes(code.encode('ascii'), 'little')
+
+def fourcc_to_str(value):
+    """Unpack a FOURCC integer into its four character code"""
+    return int(value).to_bytes(4, 'little').decode('ascii', 'replace')
+
+# Pixel formats handled by V4L2Capture.retrieve
+V4L2_PIX_FMT_MJPEG = fourcc_from_str('MJPG')
+V4L2_PIX_FMT_JPEG = fourcc_from_str('JPEG')
+V4L2_PIX_FMT_BGR24 = fourcc_from_str('BGR3')
+V4L2_PIX_FMT_YUYV = fourcc_from_str('YUYV')
+V4L2_PIX_FMT_YUV420 = fourcc_from_str('YU12')
+V4L2_PIX_FMT_YVU420 = fourcc_from_str('YV12')
+V4L2_PIX_FMT_GREY = fourcc_from_str('GREY')
+
+class V4L2Capture:
+    """Minimal V4L2 mmap capture with a cv2.VideoCapture-like interface"""
+
+    # Buffers handed out as frame views stay away from the driver until the caller
+    # passes the view back as retrieve()'s image, as the web server does when it reuses
+    # one of its frame slots. At most this many are lent out, older ones are requeued.
+    HOLD_BUFFERS = 3
+
+    def __init__(self, device_path, fourcc=None, width=None, height=None, buffer_count=4, timeout=2.0):
+        self.fd = -1
+        self.timeout = timeout
+        self.buffers = []
+        self.views = []
+        # Buffer index -> frame view lent to the caller, oldest first
+        self.lent = {}
+        self.current = None
+        self.bytesused = 0
+        self.streaming = False
+        self.convert_rgb = True
+
+        try:
+            self.fd = os.open(device_path, os.O_RDWR | os.O_NONBLOCK)
+            self._setup(fourcc, width, height, buffer_count)
+        except OSError as e:
+            logger.error(f"Failed to open V4L2 device {device_path}: {e}")
+            self.release()
+
+    def _setup(self, fourcc, width, height, buffer_count):
+        cap = v4l2_capability()
+        fcntl.ioctl(self.fd, VIDIOC_QUERYCAP, cap)
+        caps = cap.device_caps if cap.capabilities & V4L2_CAP_DEVICE_CAPS else cap.capabilities
+        if not caps & V4L2_CAP_VIDEO_CAPTURE or not caps & V4L2_CAP_STREAMING:
+            raise OSError(f"{cap.card.decode(errors='replace')} does not support streaming capture")
+
+        # Negotiate the format before any buffers are requested
+        fmt = v4l2_format()
+        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fcntl.ioctl(self.fd, VIDIOC_G_FMT, fmt)
+        if fourcc:
+            fmt.fmt.pix.pixelformat = fourcc_from_str(fourcc)
+        if width and height:
+            fmt.fmt.pix.width = width
+            fmt.fmt.pix.height = height
+        fmt.fmt.pix.field = V4L2_FIELD_ANY
+        fcntl.ioctl(self.fd, VIDIOC_S_FMT, fmt)
+        self.pix = fmt.fmt.pix
+
+        # Keep at least two buffers queued with the driver besides the lent ones
+        requested = max(buffer_count, self.HOLD_BUFFERS + 2)
+        req = v4l2_requestbuffers()
+        req.count = requested
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self.fd, VIDIOC_REQBUFS, req)
+        if req.count <= self.HOLD_BUFFERS:
+            raise OSError(f"driver only allocated {req.count} buffers")
+        logger.info(f"V4L2 allocated {req.count} buffers (requested {requested})")
+
+        for index in range(req.count):
+            buf = v4l2_buffer()
+            buf.index = index
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_MMAP
+            fcntl.ioctl(self.fd, VIDIOC_QUERYBUF, buf)
+
+            mm = mmap.mmap(self.fd, buf.length, mmap.MAP_SHARED, mmap.PROT_READ, offset=buf.m.offset)
+            self.buffers.append(mm)
+            self.views.append(np.frombuffer(mm, dtype=np.uint8))
+            self._queue(index)
+
+        fcntl.ioctl(self.fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        self.streaming = True
+
+    def _queue(self, index):
+        buf = v4l2_buffer()
+        buf.index = index
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self.fd, VIDIOC_QBUF, buf)
+
+    def isOpened(self):
+        return self.streaming
+
+    @staticmethod
+    def _dst(image, shape):
+        """Return image if a conversion to shape can be written into it, otherwise None
+
+        The previous slot may be a read-only view of a driver buffer or a frame of
+        another format, those cannot be reused.
+        """
+        if image is None or not image.flags.writeable or image.shape != shape or image.dtype != np.uint8:
+            return None
+        return image
+
+    def _dequeue(self):
+        """Take a filled buffer from the driver without blocking, None if there is none"""
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        try:
+            fcntl.ioctl(self.fd, VIDIOC_DQBUF, buf)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                logger.warning(f"VIDIOC_DQBUF failed: {e}")
+            return None
+        return buf
+
+    def grab(self):
+        """Wait for a filled buffer and take the newest one from the driver
+
+        Frames that queued up while the caller was busy are dequeued in the same
+        call and handed straight back, so only the latest frame is kept.
+        """
+        if not self.streaming:
+            return False
+
+        ready, _, _ = select.select([self.fd], [], [], self.timeout)
+        if not ready:
+            return False
+
+        buf = self._dequeue()
+        if buf is None:
+            return False
+
+        while True:
+            newer = self._dequeue()
+            if newer is None:
+                break
+            self._queue(buf.index)
+            buf = newer
+
+        # A previous frame that was converted or never retrieved is not referenced anymore
+        if self.current is not None and self.current not in self.lent:
+            self._queue(self.current)
+
+        self.current = buf.index
+        self.bytesused = buf.bytesused
+        return True
+
+    def _lend(self, frame, image):
+        """Hand out a view of the current buffer, giving the buffer behind image back to the driver"""
+        if image is not None:
+            for index, view in self.lent.items():
+                if view is image and index != self.current:
+                    del self.lent[index]
+                    self._queue(index)
+                    break
+
+        self.lent[self.current] = frame
+        while len(self.lent) > self.HOLD_BUFFERS:
+            index = next(iter(self.lent))
+            del self.lent[index]
+            self._queue(index)
+        return frame
+
+    @staticmethod
+    def _pack_yuv420(view, w, h, stride, out=None):
+        """Copy a planar 4:2:0 frame with padded rows into a contiguous (h * 3/2, w) frame"""
+        if out is None:
+            out = np.empty((h * 3 // 2, w), dtype=np.uint8)
+        luma_size = stride * h
+        # Both chroma planes follow the luma plane with half the stride and height
+        out[:h] = view[:luma_size].reshape(h, stride)[:, :w]
+        chroma = view[luma_size:luma_size + stride // 2 * h].reshape(h, stride // 2)[:, :w // 2]
+        out.reshape(-1)[w * h:].reshape(h, w // 2)[...] = chroma
+        return out
+
+    def retrieve(self, image=None):
+        """Return the grabbed frame
+
+        BGR3 frames and compressed MJPG payloads are returned as views of the
+        driver buffer, as are YU12/YV12 frames of shape (h * 3/2, w) when
+        CAP_PROP_CONVERT_RGB is off, unless the driver pads their rows, in which
+        case they are packed into image (or a new array) instead. Passing a previously returned view as image
+        gives its buffer back to the driver. Other formats are converted to BGR,
+        into image when it is a writable frame of the right size.
+        """
+        if self.current is None:
+            return False, None
+
+        view = self.views[self.current]
+        pix = self.pix
+        w, h, stride = pix.width, pix.height, pix.bytesperline
+        pixelformat = pix.pixelformat
+
+        if pixelformat in (V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG):
+            return True, self._lend(view[:self.bytesused], image)
+
+        if pixelformat == V4L2_PIX_FMT_BGR24:
+            frame = view[:h * stride].reshape(h, stride)[:, :w * 3].reshape(h, w, 3)
+            return True, self._lend(frame, image)
+
+        if pixelformat == V4L2_PIX_FMT_YUYV:
+            frame = view[:h * stride].reshape(h, stride)[:, :w * 2].reshape(h, w, 2)
+            return True, cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV, dst=self._dst(image, (h, w, 3)))
+
+        if pixelformat in (V4L2_PIX_FMT_YUV420, V4L2_PIX_FMT_YVU420):
+            if stride == w:
+                frame = view[:w * h * 3 // 2].reshape(h * 3 // 2, w)
+                if not self.convert_rgb:
+                    return True, self._lend(frame, image)
+            else:
+                frame = self._pack_yuv420(view, w, h, stride, self._dst(image, (h * 3 // 2, w)))
+                if not self.convert_rgb:
+                    return True, frame
+            code = cv2.COLOR_YUV2BGR_I420 if pixelformat == V4L2_PIX_FMT_YUV420 else cv2.COLOR_YUV2BGR_YV12
+            return True, cv2.cvtColor(frame, code, dst=self._dst(image, (h, w, 3)))
+
+        if pixelformat == V4L2_PIX_FMT_GREY:
+            frame = view[:h * stride].reshape(h, stride)[:, :w]
+            return True, cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=self._dst(image, (h, w, 3)))
+
+        logger.error(f"Unsupported V4L2 pixel format {fourcc_to_str(pixelformat)}")
+        return False, None
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop):
+        if not self.streaming:
+            return 0.0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.pix.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.pix.height)
+        if prop == cv2.CAP_PROP_FOURCC:
+            return float(self.pix.pixelformat)
+        if prop == cv2.CAP_PROP_BUFFERSIZE:
+            return float(len(self.buffers))
+        if prop == cv2.CAP_PROP_FPS:
+            parm = v4l2_streamparm()
+            parm.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            try:
+                fcntl.ioctl(self.fd, VIDIOC_G_PARM, parm)
+            except OSError:
+                return 0.0
+            tpf = parm.parm.capture.timeperframe
+            return tpf.denominator / tpf.numerator if tpf.numerator else 0.0
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.convert_rgb = bool(value)
+            return True
+        # Format and buffers are fixed once streaming, pass them to the constructor instead
+        return False
+
+    def release(self):
+        if self.streaming:
+            try:
+                fcntl.ioctl(self.fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+            except OSError:
+                pass
+            self.streaming = False
+
+        # Frames handed out may still reference the mappings, those are unmapped once collected
+        self.views = []
+        for mm in self.buffers:
+            try:
+                mm.close()
+            except BufferError:
+                pass
+        self.buffers = []
+        self.lent.clear()
+        self.current = None
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1